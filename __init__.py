@@ -1,157 +1,246 @@
-import json
 import logging
 import re
-import traceback
+import time
 from datetime import datetime
 from typing import Union
 from fastapi import Request
-from fastapi import Response
-from fastapi.responses import StreamingResponse
-
+from starlette.types import ASGIApp
+from starlette.types import Message
+from starlette.types import Receive
+from starlette.types import Scope
+from starlette.types import Send
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    try:
+        from ujson import loads as _loads
+    except ImportError:
+        from json import loads as _loads
+
+# Шаблоны ищутся (re.search) в scope["path"], а не в полном URL.
 EXCLUDE_PATHS = {
-    r".+\/live",
-    r".+\/ready",
-    r".+\/healthcheck",
-    r".+\/docs",
-    r".+\/openapi.json",
-    r".+\/favicon.ico",
+    r"/live/?$",
+    r"/ready/?$",
+    r"/healthcheck/?$",
+    r"/docs(?:/|$)",
+    r"/openapi\.json$",
+    r"/favicon\.ico$",
 }
 
+BODY_METHODS = frozenset({"PATCH", "POST", "PUT"})
+
+MAX_RESPONSE_SIZE = 64 * 1024
+
+TEXT_CONTENT_TYPES = (b"application/json", b"application/xml", b"text/")
+
 
 class HTTPMiddleware:
 
-    @classmethod
-    async def log(cls, event_method: str, event: str, context: dict, logger=None) -> None:
-        if logger:
-            await getattr(logger, event_method.lower())(event, **context)
+    def __init__(self, app: ASGIApp, logger: logging.Logger = None, *, exclude_paths: set[str] = None) -> None:
+        self.app = app
+        self.logger = logger
+        self.is_enabled_for = getattr(logger, "isEnabledFor", None)
+        self.exclude_re = re.compile("|".join(f"(?:{path})" for path in exclude_paths)) if exclude_paths else None
+        self.facility = None
+        self.action_name = None
+
+        if logger is None:
+            self.handle = app
+            return
+
+        # Методы логгера связываются один раз при создании middleware: логгер не меняется за время его жизни.
+        # Ленивые прокси-логгеры (например, structlog) остаются привязанными к конфигурации на момент создания.
+        self._log_info = logger.info
+        self._log_error = logger.error
+
+        if self.exclude_re and self.is_enabled_for:
+            self.handle = self._dispatch_excluding_by_level
+        elif self.exclude_re:
+            self.handle = self._dispatch_excluding
+        elif self.is_enabled_for:
+            self.handle = self._dispatch_by_level
+        else:
+            self.handle = self._dispatch
 
-    @classmethod
-    def init_context(cls, request: Request) -> dict:
+    def init_context(self, request: Request) -> dict:
         context = {
             "method": request.method,
-            "query_params": {k: v for k, v in request.query_params.items()},
+            "query_string": request.scope["query_string"],
             "timestamp": datetime.utcnow(),
             "level_name": "INFO",
             "level": logging.INFO,
             "url": request.url,
             "url_mask": request.url,
             "request_path": request.url.path,
-            "headers": {k: v for k, v in request.headers.items()},
+            "headers": request.scope["headers"],
         }
 
-        if request.scope.get("app", None):
-            if request.scope["app"].title:
-                context["facility"] = request.scope["app"].title
+        if self.action_name is None:
+            app = request.scope.get("app", None)
+            if app and app.title:
+                self.facility = app.title
+                self.action_name = f"{self.facility}.{HTTPMiddleware.__name__}"
+            else:
+                self.action_name = HTTPMiddleware.__name__
 
-        if context.get("facility", None):
-            context["action_name"] = f"{context['facility']}.{HTTPMiddleware.__name__}"
-        else:
-            context["action_name"] = HTTPMiddleware.__name__
+        if self.facility:
+            context["facility"] = self.facility
+        context["action_name"] = self.action_name
 
         return context
 
     @classmethod
-    async def parse_body(cls, request: Request) -> Union[str, bytes]:
-        async def __receive() -> dict:
+    async def read_body(cls, receive: Receive) -> tuple[bytes, Receive]:
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                break
+            body.extend(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+
+        data = bytes(body)
+        if message["type"] == "http.request":
+            message = {"type": "http.request", "body": data, "more_body": False}
+
+        async def __receive() -> Message:
             """
-            Статический результат работы request._receive который запускается в await request.body().
+            Повторно отдает приложению уже прочитанное сообщение, далее проксирует исходный receive.
 
             Необходимо для возможности просмотра body из входящего запроса иначе приложение блокируется.
             """
-            return {"type": "http.request", "body": body}
+            nonlocal message
+            if message is None:
+                return await receive()
+            pending, message = message, None
+            return pending
 
-        body: bytes = await request.body()
-
-        request._receive = __receive
+        return data, __receive
 
+    @classmethod
+    def parse_body(cls, request: Request, body: bytes) -> Union[str, bytes]:
         payload = body
         if not payload:
             return payload
 
-        if request.headers.get("Content-Type") == "application/json":
+        content_type = next((value for key, value in request.scope["headers"] if key == b"content-type"), b"")
+        if content_type.lower().startswith(b"application/json"):
             try:
-                payload = json.loads(body.decode("utf-8").replace("\n", ""))
-            except json.JSONDecodeError:
+                payload = _loads(body)
+            except ValueError:
                 # FastAPI 422 Error: Unprocessable Entity
                 ...
 
         return payload
 
-    @classmethod
-    async def parse_response(cls, response: StreamingResponse) -> str:
-        content = b""
-        async for chunk in response.body_iterator:
-            content += chunk
-        return content.decode("utf-8")
+    async def log_error(self, context: dict, e: Exception) -> None:
+        context["level_name"] = "ERROR"
+        context["level"] = logging.ERROR
+        context["exception"] = str(e)
+        context["exc_info"] = (type(e), e, e.__traceback__)
+        context["status_code"] = 500
 
-    @classmethod
-    async def _proxy(cls, request: Request, call_next, logger=None) -> Response:
-        context = cls.init_context(request)
+        await self._log_error("http.error", **context)
 
-        if request.method in {"PATCH", "POST", "PUT"}:
-            context["request_data"] = await cls.parse_body(request)
+    async def _proxy_errors(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await self.app(scope, receive, send)
+        except Exception as e:
+            await self.log_error(self.init_context(Request(scope)), e)
+            raise e
 
-        await cls.log(
-            event_method=context["level_name"],
-            event=f"HTTP Request {context['url']}",
-            context=context,
-            logger=logger,
-        )
+    async def _proxy(self, scope: Scope, receive: Receive, send: Send) -> None:
+        start = time.perf_counter()
+        request = Request(scope)
+        context = self.init_context(request)
+
+        if request.method in BODY_METHODS:
+            body, receive = await self.read_body(receive)
+            context["request_data"] = self.parse_body(request, body)
+
+        await self._log_info("http.request", **context)
+
+        status_code = 500
+        content_type = b""
+        content_length = 0
+        buf = bytearray()
+        capture = False
+
+        async def _send(message: Message) -> None:
+            nonlocal status_code, content_type, content_length, capture
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                for key, value in message.get("headers", ()):
+                    if key.lower() == b"content-type":
+                        content_type = value
+                        capture = value.lower().startswith(TEXT_CONTENT_TYPES)
+                        break
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                content_length += len(chunk)
+                if capture:
+                    if content_length > MAX_RESPONSE_SIZE:
+                        capture = False
+                        buf.clear()
+                    else:
+                        buf.extend(chunk)
+            await send(message)
 
         try:
-            response = await call_next(request)
+            await self.app(scope, receive, _send)
         except Exception as e:
-            context["level_name"] = "ERROR"
-            context["level"] = logging.ERROR
-            context["exception"] = str(e)
-            context["stack_trace"] = "".join(line for line in (traceback.format_tb(e.__traceback__)))
-            context["status_code"] = 500
-
-            await cls.log(
-                event_method=context["level_name"],
-                event=f"HTTP Error {context['url']}",
-                context=context,
-                logger=logger,
-            )
+            await self.log_error(context, e)
             raise e
 
         finally:
-            route = request.scope.get("route", None)
+            route = scope.get("route", None)
             if route:
                 context["url_mask"] = f"{request.base_url}{route.path[1:]}"
 
-        content = await cls.parse_response(response)
+        context["status_code"] = status_code
+        if capture:
+            context["response_data"] = buf.decode("utf-8", errors="replace")
+        else:
+            context["response_data"] = f"<{content_length} bytes {content_type.decode('latin-1')}>"
+        context["elapsed"] = round(time.perf_counter() - start, 4)
 
-        context["status_code"] = response.status_code
-        context["response_data"] = content
-        context["elapsed"] = round(datetime.utcnow().timestamp() - context["timestamp"].timestamp(), 4)
+        await self._log_info("http.response", **context)
 
-        await cls.log(
-            event_method=context["level_name"],
-            event=f"HTTP Response {context['url']}",
-            context=context,
-            logger=logger,
-        )
+    async def _dispatch(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
 
-        return Response(
-            content=content,
-            status_code=response.status_code,
-            headers=dict(response.headers),
-            media_type=response.media_type,
-        )
+        await self._proxy(scope, receive, send)
 
-    @classmethod
-    async def proxy(
-        cls,
-        request: Request,
-        call_next,
-        logger: logging.Logger = None,
-        *,
-        exclude_paths: set[str] = None,
-    ) -> Response:
-        if exclude_paths:
-            matches = [path for path in exclude_paths if re.match(path, str(request.url))]
-            if matches:
-                return await call_next(request)
-
-        return await cls._proxy(request, call_next, logger)
+    async def _dispatch_by_level(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+        elif self.is_enabled_for(logging.INFO):
+            await self._proxy(scope, receive, send)
+        elif self.is_enabled_for(logging.ERROR):
+            await self._proxy_errors(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+    async def _dispatch_excluding(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or self.exclude_re.search(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        await self._proxy(scope, receive, send)
+
+    async def _dispatch_excluding_by_level(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or self.exclude_re.search(scope["path"]):
+            await self.app(scope, receive, send)
+        elif self.is_enabled_for(logging.INFO):
+            await self._proxy(scope, receive, send)
+        elif self.is_enabled_for(logging.ERROR):
+            await self._proxy_errors(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await self.handle(scope, receive, send)